@@ -3,15 +3,27 @@ monkey.patch_all()
 # important for production - gevent is swapping out Python’s blocking I/O functions with cooperative versions,
 # so the app can handle thousands of concurrent SSE connections without threads.
 
+import gevent
+import hmac
 import json
+import math
+import os
+import tempfile
 import time
 import threading
 import queue
 from contextlib import contextmanager
 from flask import Flask, render_template, jsonify, Response, request, stream_with_context
 from kubernetes import client, config, watch
+from kubernetes.client.rest import ApiException
 
 from .backend import backend, __version__ as kuyala_version
+from .backend.rate_limiter import Priority
+from .backend.conflating_queue import ConflatingQueue
+from .backend.cluster_state import ClusterState, StateCheckpoint
+from .backend.history import HistoryStore
+from .backend.hub_monitor import HubMonitor, SamplingProfiler
+from .backend.groups import dependency_levels, lock_group
 
 app = Flask(__name__, template_folder='./templates')
 kuyala_backend = backend.Backend()
@@ -22,12 +34,30 @@ connected_clients = []
 clients_lock = threading.Lock()
 # New queue for delayed stats updates
 delayed_stats_queue = queue.Queue()
+# Cached deployments, stats and watch position, checkpointed to disk for a warm start
+cluster_state = ClusterState()
+state_file = os.environ.get('KUYALA_STATE_FILE', os.path.join(tempfile.gettempdir(), 'kuyala_state.sqlite'))
+state_checkpoint = StateCheckpoint(state_file, max_age=kuyala_backend.env_number('KUYALA_STATE_MAX_AGE', 3600, float)) if state_file else None
+state_checkpoint_interval = kuyala_backend.env_number('KUYALA_STATE_INTERVAL', 15, float)
+# Downsampled history of the cluster stats and replicas of each deployment
+history = HistoryStore()
+# Reports greenlets blocking the gevent hub, the profiler endpoint is enabled only with a token
+hub_monitor = HubMonitor(threshold=kuyala_backend.env_number('KUYALA_HUB_BLOCK_THRESHOLD', 0.5, float))
+hub_monitor.install()
+profiler = SamplingProfiler()
+profiler_token = os.environ.get('KUYALA_PROFILER_TOKEN', '')
+group_ready_timeout = kuyala_backend.env_number('KUYALA_GROUP_READY_TIMEOUT', 300, float)
 
 
 config_error = ""
 if not kuyala_backend.client:
     config_error = "Configuration error: KUBECONFIG or KUBERNETES_SERVICE_HOST environment variable is not set and not running in-cluster."
     kuyala_backend.logging.error(config_error)
+elif state_checkpoint:
+    # SQLite and the checkpoint lock block in C, keep them off the gevent hub
+    warm_snapshot = gevent.get_hub().threadpool.apply(state_checkpoint.load, (kuyala_backend.client.configuration.host,))
+    if warm_snapshot:
+        cluster_state.restore(warm_snapshot)
 
 
 @app.context_processor
@@ -37,11 +67,11 @@ def inject_version():
 
 
 @contextmanager
-def k8s_client_session(thread_name: str):
+def k8s_client_session(thread_name: str, priority: Priority = Priority.STATS):
     """A context manager to ensure a valid K8s client is available for a thread."""
     is_valid = False
     try:
-        kuyala_backend.k8s_auth_and_validate()
+        kuyala_backend.k8s_auth_and_validate(priority)
         if kuyala_backend.client:
             is_valid = True
         else:
@@ -56,63 +86,128 @@ class SSEClient:
     """Represents a single SSE client connection"""
     def __init__(self, client_id):
         self.id = client_id
-        self.queue = queue.Queue(maxsize=50)
+        self.queue = ConflatingQueue()
         self.connected = True
 
 
+def message_key(message):
+    """Key under which pending messages of a slow client are merged, None if the message must not be merged"""
+    event_type = message.get('event')
+    if event_type == 'deployment_update':
+        data = message.get('data', {})
+        return event_type, data.get('namespace'), data.get('name')
+    if event_type == 'stats_update':
+        return event_type
+    if event_type == 'group_update':
+        return event_type, message.get('data', {}).get('group')
+    return None
+
+
 def broadcast_message(message):
     """Broadcast message to all connected SSE clients"""
+    key = message_key(message)
     with clients_lock:
         for client in connected_clients:
-            try:
-                if client.connected:
-                    client.queue.put_nowait(message)
-            except queue.Full:
-                kuyala_backend.logging.warning(f"Queue full for client {client.id}, dropping message")
+            if client.connected:
+                client.queue.put_nowait(message, key)
+
+
+def replicas_history_key(namespace, name):
+    return f"deployment.{namespace}.{name}.replicas"
+
+
+def end_replicas_history(namespace, name):
+    """Records a deleted deployment as scaled to zero, its history is dropped after the retention period."""
+    key = replicas_history_key(namespace, name)
+    history.record(key, 0)
+    history.end(key)
+
+
+def record_history(stats):
+    """Records the cluster stats and the current replicas of every cached deployment."""
+    now = time.time()
+    history.prune(now)
+    for metric, value in stats.items():
+        history.record(f"cluster.{metric}", value, now)
+    for deployment_data in cluster_state.deployment_list():
+        history.record(replicas_history_key(deployment_data["namespace"], deployment_data["name"]), deployment_data["replicasCurrent"], now)
+
+
+def relist_deployments(v1_apps):
+    """
+    Lists all deployments, replaces the state cache and broadcasts the difference.
+    Returns the resourceVersion to start the watch from.
+    """
+    deployment_list = kuyala_backend.api_call(Priority.WATCH, v1_apps.list_deployment_for_all_namespaces)
+    deployments = [
+        data for data in (kuyala_backend.deployment_data(dep, "MODIFIED") for dep in deployment_list.items)
+        if data
+    ]
+    removed = cluster_state.replace_deployments(deployments, deployment_list.metadata.resource_version)
+    for deployment_data in removed:
+        end_replicas_history(deployment_data["namespace"], deployment_data["name"])
+        broadcast_message({"event": "deployment_update", "data": {**deployment_data, "type": "DELETED", "timestamp": time.time()}})
+    for deployment_data in deployments:
+        broadcast_message({"event": "deployment_update", "data": deployment_data})
+    kuyala_backend.logging.info(f"Listed {len(deployments)} Kuyala-enabled deployments at resourceVersion {deployment_list.metadata.resource_version}")
+    return deployment_list.metadata.resource_version
 
 
 def watch_deployments():
     """
     Watch Kubernetes deployments for changes and broadcast via SSE.
     This runs in a background thread.
+    The watch resumes from the last seen resourceVersion, a full list is done only when there is none or it has expired.
     """
     kuyala_backend.logging.info("Starting Kubernetes deployment watcher...")
     while True:
-        with k8s_client_session("Watcher") as is_ready:
+        with k8s_client_session("Watcher", Priority.WATCH) as is_ready:
             if not is_ready:
                 time.sleep(30)
                 continue
             
             try:
                 v1_apps = client.AppsV1Api(kuyala_backend.client)
+                resource_version = cluster_state.resource_version or relist_deployments(v1_apps)
                 w = watch.Watch()
-                for event in w.stream(v1_apps.list_deployment_for_all_namespaces, timeout_seconds=0):
+                # Opening a new watch stream is an API call as well, let it queue behind user actions
+                kuyala_backend.rate_limiter.acquire(Priority.WATCH)
+                kuyala_backend.logging.info(f"Watching deployments from resourceVersion {resource_version}")
+                for event in w.stream(v1_apps.list_deployment_for_all_namespaces, resource_version=resource_version, timeout_seconds=0):
                     event_type = event['type']
                     deployment = event['object']
-
-                    annotations = deployment.metadata.annotations or {}
-                    if "kuyala.enabled" not in annotations:
+                    cluster_state.set_resource_version(deployment.metadata.resource_version)
+
+                    deployment_data = kuyala_backend.deployment_data(deployment, event_type)
+                    if not deployment_data:
+                        # The kuyala.enabled annotation may have been removed from a cached deployment
+                        removed = cluster_state.remove_deployment(deployment.metadata.namespace, deployment.metadata.name)
+                        if removed:
+                            end_replicas_history(removed["namespace"], removed["name"])
+                            broadcast_message({
+                                "event": "deployment_update",
+                                "data": {**removed, "type": "DELETED", "timestamp": time.time()}
+                            })
                         continue
 
-                    replicas_current = getattr(deployment.status, "replicas", 0) or 0
-
-                    deployment_data = {
-                        "type": event_type,
-                        "namespace": deployment.metadata.namespace,
-                        "name": deployment.metadata.name,
-                        "applicationName": annotations.get("kuyala.applicationName", deployment.metadata.name),
-                        "backgroundColor": annotations.get("kuyala.backgroundColor", ""),
-                        "textColor": annotations.get("kuyala.textColor", ""),
-                        "replicasOff": int(annotations.get("kuyala.replicasOff", 0)),
-                        "replicasOn": int(annotations.get("kuyala.replicasOn", 1)),
-                        "replicasCurrent": replicas_current,
-                        "timestamp": time.time()
-                    }
+                    if event_type == "DELETED":
+                        cluster_state.remove_deployment(deployment_data["namespace"], deployment_data["name"])
+                        end_replicas_history(deployment_data["namespace"], deployment_data["name"])
+                    else:
+                        cluster_state.update_deployment(deployment_data)
+                        history.record(replicas_history_key(deployment_data["namespace"], deployment_data["name"]), deployment_data["replicasCurrent"])
 
                     broadcast_message({
                         "event": "deployment_update",
                         "data": deployment_data
                     })
+            except ApiException as e:
+                if e.status == 410:
+                    kuyala_backend.logging.info("Deployment watch resourceVersion expired, listing deployments again")
+                    cluster_state.expire_resource_version()
+                else:
+                    kuyala_backend.logging.error(f"Error in deployment watcher stream: {e}", exc_info=True)
+                    time.sleep(5)
             except Exception as e:
                 kuyala_backend.logging.error(f"Error in deployment watcher stream: {e}", exc_info=True)
                 time.sleep(5)
@@ -125,8 +220,10 @@ def stats_updater():
         with k8s_client_session("StatsUpdater") as is_ready:
             if is_ready:
                 try:
-                    stats = kuyala_backend.get_cluster_stats()
+                    stats = kuyala_backend.get_cluster_stats(Priority.STATS)
                     if stats:
+                        cluster_state.set_stats(stats)
+                        record_history(stats)
                         kuyala_backend.logging.info(f"Broadcasting stats update: {stats}")
                         broadcast_message({"event": "stats_update", "data": stats})
                 except Exception as e:
@@ -146,14 +243,93 @@ def delayed_stats_trigger():
 
             with k8s_client_session("DelayedStatsTrigger") as is_ready:
                 if is_ready:
-                    stats = kuyala_backend.get_cluster_stats()
+                    stats = kuyala_backend.get_cluster_stats(Priority.STATS)
                     if stats:
+                        cluster_state.set_stats(stats)
+                        record_history(stats)
                         kuyala_backend.logging.info(f"Broadcasting delayed stats update: {stats}")
                         broadcast_message({"event": "stats_update", "data": stats})
         except Exception as e:
             kuyala_backend.logging.error(f"Error in delayed stats trigger: {e}", exc_info=True)
 
 
+def member_settled(deployment_data, action):
+    """True when a started member has all replicas ready, or a stopped member has scaled down."""
+    if deployment_data is None:
+        return action == 'stop'
+    if action == 'start':
+        return deployment_data.get('replicasReady', 0) >= deployment_data['replicasOn']
+    return deployment_data['replicasCurrent'] <= deployment_data['replicasOff']
+
+
+def run_group_action(group, action, levels, group_lock):
+    """
+    Scales the members of a group level by level, the members of one level in parallel.
+    The next level starts once the deployment watch reports the current level settled.
+    Releases the group lock when finished.
+    """
+    def broadcast_group_update(status, level=None, message=None):
+        broadcast_message({"event": "group_update", "data": {
+            "group": group, "action": action, "status": status, "level": level,
+            "levels": len(levels), "message": message, "timestamp": time.time()
+        }})
+
+    started = time.time()
+    try:
+        for level_index, level in enumerate(levels):
+            broadcast_group_update('running', level_index)
+            results = {}
+
+            def scale_member(deployment_data):
+                scale = deployment_data['replicasOn'] if action == 'start' else deployment_data['replicasOff']
+                results[(deployment_data['namespace'], deployment_data['name'])] = kuyala_backend.action({
+                    'namespace': deployment_data['namespace'], 'name': deployment_data['name'], 'scale': scale
+                })
+
+            threads = [threading.Thread(target=scale_member, args=(d,), daemon=True) for d in level]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            failed = sorted(f"{namespace}/{name}" for (namespace, name), result in results.items() if result is None)
+            if failed:
+                raise RuntimeError(f"Failed to scale {', '.join(failed)}")
+
+            keys = [(d['namespace'], d['name']) for d in level]
+            settled = cluster_state.wait_for(
+                lambda deployments: all(member_settled(deployments.get(key), action) for key in keys),
+                group_ready_timeout
+            )
+            if not settled:
+                raise RuntimeError(f"Level {level_index} not ready within {group_ready_timeout}s")
+            kuyala_backend.logging.info(f"Group '{group}' {action}: level {level_index} settled after {time.time() - started:.1f}s")
+
+        kuyala_backend.logging.info(f"Group '{group}' {action} finished in {time.time() - started:.1f}s")
+        broadcast_group_update('success')
+    except Exception as e:
+        kuyala_backend.logging.error(f"Group '{group}' {action} failed: {e}")
+        broadcast_group_update('error', message=str(e))
+    finally:
+        group_lock.close()
+        delayed_stats_queue.put("trigger")
+
+
+def state_checkpointer():
+    """Periodically writes the changed cluster state to the checkpoint file."""
+    kuyala_backend.logging.info(f"Starting state checkpointer thread, writing to {state_checkpoint.path}...")
+    while True:
+        time.sleep(state_checkpoint_interval)
+        try:
+            if cluster_state.dirty and cluster_state.ready and kuyala_backend.client:
+                changes, snapshot = cluster_state.snapshot()
+                saved = gevent.get_hub().threadpool.apply(state_checkpoint.save, (snapshot, kuyala_backend.client.configuration.host))
+                if saved:
+                    cluster_state.mark_saved(changes)
+        except Exception as e:
+            kuyala_backend.logging.error(f"Error in state checkpointer: {e}", exc_info=True)
+
+
 # Start the background threads
 if not config_error:
     watcher_thread = threading.Thread(target=watch_deployments, daemon=True)
@@ -162,6 +338,9 @@ if not config_error:
     stats_thread.start()
     delayed_stats_thread = threading.Thread(target=delayed_stats_trigger, daemon=True)
     delayed_stats_thread.start()
+    if state_checkpoint:
+        checkpoint_thread = threading.Thread(target=state_checkpointer, daemon=True)
+        checkpoint_thread.start()
 
 
 @app.route('/')
@@ -189,11 +368,15 @@ def events():
 
         yield f"event: connected\ndata: {json.dumps({'client_id': client_id, 'message': 'Connected to Kuyala', 'server_node_name': kuyala_backend.master_node_name, 'server_node_ip': kuyala_backend.master_node_ip})}\n\n"
 
-        initial_data = kuyala_backend.get_current_list()
+        # Serve the cached state as soon as it is known, the watch keeps it current
+        if cluster_state.ready:
+            initial_data = {'status': 'success', 'data': cluster_state.deployment_list()}
+        else:
+            initial_data = kuyala_backend.get_current_list(Priority.SNAPSHOT)
         if initial_data.get('status') == 'success':
             yield f"event: initial_data\ndata: {json.dumps(initial_data)}\n\n"
         
-        initial_stats = kuyala_backend.get_cluster_stats()
+        initial_stats = cluster_state.stats or kuyala_backend.get_cluster_stats(Priority.SNAPSHOT)
         if initial_stats:
             yield f"event: stats_update\ndata: {json.dumps(initial_stats)}\n\n"
 
@@ -276,6 +459,113 @@ def action():
         }), 500
 
 
+@app.route('/group_action', methods=['POST'])
+def group_action():
+    """
+    Starts or stops all deployments of a `kuyala.group` in the order given by their `kuyala.dependsOn` annotations.
+    Starting scales the dependencies first, stopping goes in reverse. Progress is broadcast as `group_update` events.
+    """
+    try:
+        req_data = request.get_json()
+        if not req_data:
+            return jsonify({'status': 'error', 'message': 'No data provided'}), 400
+
+        group = req_data.get('group')
+        action = req_data.get('action')
+        if not group or not isinstance(group, str) or action not in ('start', 'stop'):
+            return jsonify({'status': 'error', 'message': 'Missing required fields: group, action (start or stop)'}), 400
+
+        if not cluster_state.ready:
+            return jsonify({'status': 'error', 'message': 'Deployments are not listed yet, try again shortly'}), 503
+
+        members = cluster_state.group_members(group)
+        if not members:
+            return jsonify({'status': 'error', 'message': f"No deployments found in group '{group}'"}), 404
+
+        try:
+            levels = dependency_levels(members)
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        if action == 'stop':
+            levels.reverse()
+
+        # The lock is shared by the workers of this host only, run a single Kuyala replica
+        group_lock = lock_group(group)
+        if group_lock is None:
+            return jsonify({'status': 'error', 'message': f"Group '{group}' is already being started or stopped"}), 409
+
+        kuyala_backend.logging.info(f"Group action request: {action} '{group}' in {len(levels)} levels")
+        threading.Thread(target=run_group_action, args=(group, action, levels, group_lock), daemon=True).start()
+
+        return jsonify({
+            'status': 'success',
+            'group': group,
+            'action': action,
+            'levels': [[f"{d['namespace']}/{d['name']}" for d in level] for level in levels]
+        }), 202
+
+    except Exception as e:
+        kuyala_backend.logging.error(f"Error in group action endpoint: {str(e)}", exc_info=True)
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
+
+@app.route('/history')
+def history_endpoint():
+    """
+    Columnar history of the metrics for sparklines.
+    Query parameters: `key` (repeatable) or `namespace` and `name` of a deployment, `range` in seconds back from now.
+    Without a key, lists the available keys.
+    """
+    keys = request.args.getlist('key')
+    namespace = request.args.get('namespace')
+    name = request.args.get('name')
+    if namespace and name:
+        keys.append(replicas_history_key(namespace, name))
+    if not keys:
+        return jsonify({'status': 'success', 'keys': history.keys()})
+
+    try:
+        history_range = float(request.args.get('range', 3600))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid range, expected number of seconds'}), 400
+
+    return jsonify({
+        'status': 'success',
+        'series': history.query(keys, history_range)
+    })
+
+
+@app.route('/debug/profile')
+def debug_profile():
+    """
+    Samples the CPU profile of this worker for `seconds` (max 60) every `interval` seconds (0.001 to `seconds`)
+    and returns it in the collapsed stack format.
+    Requires the `X-Kuyala-Token` header matching KUYALA_PROFILER_TOKEN.
+    """
+    if not profiler_token:
+        return jsonify({'status': 'error', 'message': 'Profiler is disabled, set KUYALA_PROFILER_TOKEN to enable it'}), 404
+    if not hmac.compare_digest(request.headers.get('X-Kuyala-Token', ''), profiler_token):
+        return jsonify({'status': 'error', 'message': 'Invalid profiler token'}), 403
+
+    try:
+        seconds = float(request.args.get('seconds', 10))
+        interval = float(request.args.get('interval', 0.01))
+    except ValueError:
+        return jsonify({'status': 'error', 'message': 'Invalid seconds or interval, expected numbers'}), 400
+    if not (math.isfinite(seconds) and math.isfinite(interval)) or seconds <= 0 or interval <= 0:
+        return jsonify({'status': 'error', 'message': 'Seconds and interval must be positive finite numbers'}), 400
+
+    kuyala_backend.logging.info(f"Profiling worker for {seconds}s, sampling every {interval}s")
+    collapsed_stacks = profiler.profile(seconds, interval)
+    if collapsed_stacks is None:
+        return jsonify({'status': 'error', 'message': 'Another profile is already running'}), 409
+
+    return Response(collapsed_stacks, mimetype='text/plain')
+
+
 @app.route('/health')
 def health():
     """Health check endpoint"""
@@ -287,7 +577,9 @@ def health():
         'master_node_ip': kuyala_backend.master_node_ip,
         'master_node_name': kuyala_backend.master_node_name,
         'timestamp': time.time(),
-        'kuyala_version': kuyala_version
+        'kuyala_version': kuyala_version,
+        'rate_limiter': kuyala_backend.rate_limiter.metrics(),
+        'hub_monitor': hub_monitor.metrics()
     }), 200
 
 
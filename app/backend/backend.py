@@ -1,9 +1,11 @@
 from __future__ import annotations
 import os
+import time
 import logging
 from kubernetes import client, config
 from kubernetes.client.rest import ApiException
 from . import __version__
+from .rate_limiter import RateLimiter, Priority
 
 def parse_memory(s):
     if not s:
@@ -34,6 +36,7 @@ class Backend(metaclass=SingletonMeta):
     master_node_ip = None
     master_node_name = None
     kuyala_version = None
+    rate_limiter: RateLimiter | None = None
 
 
 
@@ -60,19 +63,42 @@ class Backend(metaclass=SingletonMeta):
             logging.warning(early_warning)
         logging.info(f"Current log level set to: {log_level_name}")
 
+        # Client-side API rate limiting, shared by all threads of this process
+        api_qps = self.env_number('KUYALA_API_QPS', 5.0, float)
+        api_burst = self.env_number('KUYALA_API_BURST', 10, int)
+        self.rate_limiter = RateLimiter(qps=api_qps, burst=api_burst)
+        logging.info(f"API rate limiter set to {api_qps} QPS, burst {api_burst}")
+
         self.k8s_auth_and_validate()
 
 
-    def k8s_auth_and_validate(self) -> bool:
+    def env_number(self, name, default, cast):
+        value = os.environ.get(name)
+        if value is None or value == "":
+            return default
+        try:
+            number = cast(value)
+            if number > 0:
+                return number
+        except ValueError:
+            pass
+        logging.warning(f"Unrecognized value '{value}' of {name}, using default {default}")
+        return default
+
+    def api_call(self, priority: Priority, func, *args, **kwargs):
+        """Calls the Kubernetes API through the shared rate limiter in the given priority lane."""
+        return self.rate_limiter.call(priority, func, *args, **kwargs)
+
+    def k8s_auth_and_validate(self, priority: Priority = Priority.STATS) -> bool:
         self.client = self.init_k8s_client()
         if not self.client:
             return False
-        if not self.validate_connection():
+        if not self.validate_connection(priority):
             self.client = None
             return False
         return True
 
-    def validate_connection(self) -> bool:
+    def validate_connection(self, priority: Priority = Priority.STATS) -> bool:
         """
         Validates the Kubernetes client connection by making a simple API call.
         """
@@ -81,11 +107,11 @@ class Backend(metaclass=SingletonMeta):
             return False
         try:
             api = client.VersionApi(self.client)
-            version_info = api.get_code()
+            version_info = self.api_call(priority, api.get_code)
             self.kubernetes_version = f"{version_info.major}.{version_info.minor}"
 
             v1 = client.CoreV1Api(self.client)
-            nodes = v1.list_node()
+            nodes = self.api_call(priority, v1.list_node)
             for node in nodes.items:
                 labels = node.metadata.labels or {}
                 if "node-role.kubernetes.io/master" in labels or "node-role.kubernetes.io/control-plane" in labels:
@@ -174,7 +200,7 @@ class Backend(metaclass=SingletonMeta):
         try:
             apps_v1 = client.AppsV1Api(self.client)
             body = {'spec': {'replicas': scale}}
-            apps_v1.patch_namespaced_deployment_scale(name, namespace, body)
+            self.api_call(Priority.ACTION, apps_v1.patch_namespaced_deployment_scale, name, namespace, body)
             logging.info(f"Successfully scaled deployment '{name}'.")
             return scale
         except ApiException as e:
@@ -185,35 +211,41 @@ class Backend(metaclass=SingletonMeta):
             logging.error(f"An unexpected error occurred during scaling action: {str(e)}")
             return None # Indicate failure
 
+    def deployment_data(self, dep, event_type="MODIFIED"):
+        """Formats a Kuyala-enabled deployment for the dashboard, None if the deployment is not enabled."""
+        annotations = dep.metadata.annotations or {}
+        if "kuyala.enabled" not in annotations:
+            return None
+
+        replicas_current = getattr(dep.status, "replicas", 0) or 0
+
+        return {
+            "type": event_type,
+            "namespace": dep.metadata.namespace,
+            "name": dep.metadata.name,
+            "applicationName": annotations.get("kuyala.applicationName", dep.metadata.name),
+            "backgroundColor": annotations.get("kuyala.backgroundColor", ""),
+            "textColor": annotations.get("kuyala.textColor", ""),
+            "replicasOff": int(annotations.get("kuyala.replicasOff", 0)),
+            "replicasOn": int(annotations.get("kuyala.replicasOn", 1)),
+            "replicasCurrent": replicas_current,
+            "replicasReady": getattr(dep.status, "ready_replicas", 0) or 0,
+            "group": annotations.get("kuyala.group", ""),
+            "dependsOn": annotations.get("kuyala.dependsOn", ""),
+            "timestamp": time.time()
+        }
+
     def get_single_deployment_data(self, namespace, name):
         """Fetches and formats data for a single deployment."""
         try:
             apps_v1 = client.AppsV1Api(self.client)
-            dep = apps_v1.read_namespaced_deployment(name, namespace)
-            
-            annotations = dep.metadata.annotations or {}
-            if "kuyala.enabled" not in annotations:
-                return None
-
-            replicas_current = dep.status.replicas if dep.status.replicas is not None else 0
-            
-            return {
-                "type": "MODIFIED",
-                "namespace": dep.metadata.namespace,
-                "name": dep.metadata.name,
-                "applicationName": annotations.get("kuyala.applicationName", dep.metadata.name),
-                "backgroundColor": annotations.get("kuyala.backgroundColor", ""),
-                "textColor": annotations.get("kuyala.textColor", ""),
-                "replicasOff": int(annotations.get("kuyala.replicasOff", 0)),
-                "replicasOn": int(annotations.get("kuyala.replicasOn", 1)),
-                "replicasCurrent": replicas_current,
-                "timestamp": time.time()
-            }
+            dep = self.api_call(Priority.SNAPSHOT, apps_v1.read_namespaced_deployment, name, namespace)
+            return self.deployment_data(dep)
         except ApiException:
             return None
 
 
-    def get_current_list(self):
+    def get_current_list(self, priority: Priority = Priority.SNAPSHOT):
         if not self.client:
             return {
                 "status": "error",
@@ -224,39 +256,28 @@ class Backend(metaclass=SingletonMeta):
         try:
             v1 = client.CoreV1Api(self.client)
             apps_v1 = client.AppsV1Api(self.client)
-            namespaces = [ns.metadata.name for ns in v1.list_namespace().items]
+            namespaces = [ns.metadata.name for ns in self.api_call(priority, v1.list_namespace).items]
 
             result_data = []
             for ns in namespaces:
-                deployments = apps_v1.list_namespaced_deployment(ns)
+                deployments = self.api_call(priority, apps_v1.list_namespaced_deployment, ns)
                 for dep in deployments.items:
-                    annotations = dep.metadata.annotations or {}
-                    if "kuyala.enabled" in annotations:
-                        creation_date = dep.metadata.creation_timestamp.isoformat() if dep.metadata.creation_timestamp else None
-                        condition = None
-                        if dep.status and dep.status.conditions:
-                            condition = [
-                                {"type": c.type, "status": c.status}
-                                for c in dep.status.conditions
-                            ]
-                        replicas_off = int(annotations.get("kuyala.replicasOff", 0))
-                        replicas_on = int(annotations.get("kuyala.replicasOn", 1))
-                        replicas_current = getattr(dep.status, "replicas", 0)
-                        if not replicas_current:
-                            replicas_current = 0
-                        result_data.append({
-                            "namespace": ns,
-                            "name": dep.metadata.name,
-                            "applicationName": annotations.get("kuyala.applicationName", dep.metadata.name),
-                            "annotations": annotations,
-                            "creationDate": creation_date,
-                            "condition": condition,
-                            "backgroundColor": annotations.get("kuyala.backgroundColor", ""),
-                            "textColor": annotations.get("kuyala.textColor", ""),
-                            "replicasOff": replicas_off,
-                            "replicasOn": replicas_on,
-                            "replicasCurrent": replicas_current
-                        })
+                    data = self.deployment_data(dep)
+                    if not data:
+                        continue
+                    creation_date = dep.metadata.creation_timestamp.isoformat() if dep.metadata.creation_timestamp else None
+                    condition = None
+                    if dep.status and dep.status.conditions:
+                        condition = [
+                            {"type": c.type, "status": c.status}
+                            for c in dep.status.conditions
+                        ]
+                    result_data.append({
+                        **data,
+                        "annotations": dep.metadata.annotations,
+                        "creationDate": creation_date,
+                        "condition": condition
+                    })
 
             # logging.info(f"Successfully fetched {len(result_data)} Kuyala-enabled deployments.")
             return {
@@ -277,7 +298,7 @@ class Backend(metaclass=SingletonMeta):
                 "message": f"An unexpected error occurred: {str(e)}"
             }
 
-    def get_cluster_stats(self):
+    def get_cluster_stats(self, priority: Priority = Priority.STATS):
         if not self.client:
             return None
 
@@ -285,8 +306,8 @@ class Backend(metaclass=SingletonMeta):
             core_v1 = client.CoreV1Api(self.client)
             apps_v1 = client.AppsV1Api(self.client)
 
-            all_deployments = apps_v1.list_deployment_for_all_namespaces().items
-            all_pods = core_v1.list_pod_for_all_namespaces().items
+            all_deployments = self.api_call(priority, apps_v1.list_deployment_for_all_namespaces).items
+            all_pods = self.api_call(priority, core_v1.list_pod_for_all_namespaces).items
 
             eligible_deployments = [
                 d for d in all_deployments
@@ -313,7 +334,7 @@ class Backend(metaclass=SingletonMeta):
                 selector = ",".join([f"{k}={v}" for k, v in dep.spec.selector.match_labels.items()])
                 
                 # Use the API to list pods matching this selector
-                dep_pods = core_v1.list_namespaced_pod(namespace=dep.metadata.namespace, label_selector=selector).items
+                dep_pods = self.api_call(priority, core_v1.list_namespaced_pod, namespace=dep.metadata.namespace, label_selector=selector).items
                 
                 for pod in dep_pods:
                     if pod.status.phase == 'Running':
@@ -0,0 +1,255 @@
+from __future__ import annotations
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import closing
+
+
+class ClusterState:
+    """
+    In-memory cache of the Kuyala-enabled deployments, the latest cluster stats
+    and the resourceVersion the deployment watch has seen last.
+    """
+
+    def __init__(self):
+        self.deployments = {}
+        self.stats = None
+        self.resource_version = None
+        self.ready = False
+        self.dirty = False
+        self._changes = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+
+    def _touch(self):
+        # Called with the lock held
+        self.dirty = True
+        self._changes += 1
+
+    def update_deployment(self, deployment_data):
+        with self._lock:
+            self.deployments[(deployment_data["namespace"], deployment_data["name"])] = deployment_data
+            self._touch()
+            self._changed.notify_all()
+
+    def remove_deployment(self, namespace, name):
+        """Removes a deployment from the cache. Returns its cached data, None if it was not cached."""
+        with self._lock:
+            removed = self.deployments.pop((namespace, name), None)
+            if removed is not None:
+                self._touch()
+                self._changed.notify_all()
+            return removed
+
+    def replace_deployments(self, deployments, resource_version):
+        """Replaces the whole cache after a full list. Returns the deployments which have disappeared."""
+        with self._lock:
+            current = {(d["namespace"], d["name"]): d for d in deployments}
+            removed = [d for key, d in self.deployments.items() if key not in current]
+            self.deployments = current
+            self.resource_version = resource_version
+            self.ready = True
+            self._touch()
+            self._changed.notify_all()
+            return removed
+
+    def set_resource_version(self, resource_version):
+        with self._lock:
+            if resource_version and resource_version != self.resource_version:
+                self.resource_version = resource_version
+                self._touch()
+
+    def expire_resource_version(self):
+        with self._lock:
+            self.resource_version = None
+            self._touch()
+
+    def set_stats(self, stats):
+        with self._lock:
+            self.stats = stats
+            self._touch()
+
+    def deployment_list(self):
+        with self._lock:
+            return sorted(self.deployments.values(), key=lambda d: (d["namespace"], d["name"]))
+
+    def group_members(self, group):
+        with self._lock:
+            return [d for d in self.deployments.values() if d.get("group") == group]
+
+    def wait_for(self, predicate, timeout=None) -> bool:
+        """Waits until `predicate(deployments)` is true, re-evaluated on every deployment change."""
+        with self._changed:
+            return self._changed.wait_for(lambda: predicate(self.deployments), timeout)
+
+    def snapshot(self):
+        """Returns the change counter and a serializable copy of the state, pass the counter to `mark_saved`."""
+        with self._lock:
+            return self._changes, {
+                "deployments": list(self.deployments.values()),
+                "stats": self.stats,
+                "resource_version": self.resource_version,
+            }
+
+    def mark_saved(self, changes):
+        """Clears the dirty flag, unless the state has changed since the saved snapshot was taken."""
+        with self._lock:
+            if changes == self._changes:
+                self.dirty = False
+
+    def restore(self, snapshot):
+        with self._lock:
+            self.deployments = {(d["namespace"], d["name"]): d for d in snapshot.get("deployments", [])}
+            self.stats = snapshot.get("stats")
+            self.resource_version = snapshot.get("resource_version")
+            self.ready = True
+            self.dirty = False
+
+
+class StateCheckpoint:
+    """
+    Persists ClusterState snapshots in a single row of an SQLite database.
+
+    Every save replaces the row in one transaction, so a reader sees either the old or the new
+    checkpoint. The payload carries a SHA-256 checksum, checkpoints which are corrupt, older
+    than `max_age` seconds or taken from a different API server are ignored on load.
+
+    All workers share the file. A lock file next to it serializes them, a save is skipped
+    when another worker holds the lock. SQLite and the lock block in C, gevent callers
+    should run `save` and `load` in the hub's threadpool.
+    """
+
+    FORMAT = 1
+
+    def __init__(self, path: str, max_age: float = 3600):
+        self.path = path
+        self.max_age = max_age
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=1)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS checkpoint ("
+            "id INTEGER PRIMARY KEY CHECK (id = 1), format INTEGER, saved_at REAL, "
+            "host TEXT, checksum TEXT, payload BLOB)"
+        )
+        return conn
+
+    def _lock(self, blocking):
+        """Returns the open lock file once the lock is held, None if it is held by another worker."""
+        lock_file = open(self.path + ".lock", "a")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        return lock_file
+
+    @staticmethod
+    def _is_corrupt(e):
+        """Busy, locked, read-only or I/O errors are transient, only a damaged file is discarded."""
+        error_name = getattr(e, "sqlite_errorname", None)
+        if error_name:
+            return error_name.startswith(("SQLITE_CORRUPT", "SQLITE_NOTADB"))
+        return not isinstance(e, sqlite3.OperationalError)
+
+    def _discard(self, reason):
+        # Called with the lock held
+        logging.warning(f"Discarding state checkpoint {self.path}: {reason}")
+        for suffix in ("", "-journal", "-wal", "-shm"):
+            try:
+                os.remove(self.path + suffix)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.error(f"Failed to remove {self.path + suffix}: {e}")
+
+    def save(self, snapshot, host) -> bool:
+        payload = zlib.compress(json.dumps(snapshot, separators=(",", ":")).encode())
+        checksum = hashlib.sha256(payload).hexdigest()
+        try:
+            lock_file = self._lock(blocking=False)
+        except OSError as e:
+            logging.error(f"Failed to lock state checkpoint {self.path}: {e}")
+            return False
+        if lock_file is None:
+            logging.debug(f"State checkpoint {self.path} is being written by another worker, skipping")
+            return False
+
+        with lock_file:
+            for attempt in range(2):
+                try:
+                    with closing(self._connect()) as conn, conn:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO checkpoint (id, format, saved_at, host, checksum, payload) "
+                            "VALUES (1, ?, ?, ?, ?, ?)",
+                            (self.FORMAT, time.time(), host, checksum, payload)
+                        )
+                    return True
+                except sqlite3.DatabaseError as e:
+                    if attempt or not self._is_corrupt(e):
+                        logging.warning(f"Failed to save state checkpoint {self.path}: {e}")
+                        return False
+                    self._discard(e)
+                except OSError as e:
+                    logging.error(f"Failed to save state checkpoint {self.path}: {e}")
+                    return False
+        return False
+
+    def _read(self):
+        """Reads the checkpoint row, None if there is none or the file is unreadable."""
+        try:
+            with closing(self._connect()) as conn:
+                integrity = conn.execute("PRAGMA quick_check").fetchone()[0]
+                if integrity != "ok":
+                    self._discard(f"integrity check failed: {integrity}")
+                    return None
+                return conn.execute(
+                    "SELECT format, saved_at, host, checksum, payload FROM checkpoint WHERE id = 1"
+                ).fetchone()
+        except sqlite3.DatabaseError as e:
+            if self._is_corrupt(e):
+                self._discard(e)
+            else:
+                logging.warning(f"Failed to read state checkpoint {self.path}: {e}")
+            return None
+
+    def load(self, host):
+        if not os.path.exists(self.path):
+            return None
+        try:
+            lock_file = self._lock(blocking=True)
+        except OSError as e:
+            logging.error(f"Failed to lock state checkpoint {self.path}: {e}")
+            return None
+        with lock_file:
+            row = self._read()
+            if not row:
+                return None
+
+            format_version, saved_at, saved_host, checksum, payload = row
+            if format_version != self.FORMAT:
+                logging.info(f"Ignoring state checkpoint {self.path}: unsupported format {format_version}")
+                return None
+            if saved_host != host:
+                logging.info(f"Ignoring state checkpoint {self.path}: taken from a different API server {saved_host}")
+                return None
+            age = time.time() - saved_at
+            if age > self.max_age:
+                logging.info(f"Ignoring state checkpoint {self.path}: stale, {age:.0f}s old")
+                return None
+            if hashlib.sha256(payload).hexdigest() != checksum:
+                self._discard("checksum mismatch")
+                return None
+            try:
+                snapshot = json.loads(zlib.decompress(payload))
+            except (zlib.error, ValueError) as e:
+                self._discard(e)
+                return None
+        logging.info(f"Loaded state checkpoint {self.path}, {age:.0f}s old, {len(snapshot.get('deployments', []))} deployments")
+        return snapshot
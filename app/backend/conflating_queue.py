@@ -0,0 +1,48 @@
+from __future__ import annotations
+import itertools
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+
+class ConflatingQueue:
+    """
+    Latest-value queue of pending SSE messages of a single client.
+
+    Messages put with the same key are merged: the pending message is replaced by the newer one
+    and keeps its place in the queue. A slow consumer therefore always receives the current state
+    and the queue never holds more than one message per key.
+    Messages put without a key are never merged.
+    """
+
+    def __init__(self):
+        self._pending = OrderedDict()
+        self._condition = threading.Condition()
+        self._sequence = itertools.count()
+        self.conflated = 0
+
+    def put_nowait(self, message, key=None):
+        """Queues a message, replacing a pending message with the same key. Never blocks."""
+        with self._condition:
+            if key is None:
+                key = ("unique", next(self._sequence))
+            elif key in self._pending:
+                self.conflated += 1
+            self._pending[key] = message
+            self._condition.notify()
+
+    def get(self, timeout: float | None = None):
+        """Returns the oldest pending message, raises `queue.Empty` when none arrives in time."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while not self._pending:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise queue.Empty
+                self._condition.wait(remaining)
+            return self._pending.popitem(last=False)[1]
+
+    def qsize(self) -> int:
+        with self._condition:
+            return len(self._pending)
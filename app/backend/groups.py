@@ -0,0 +1,64 @@
+from __future__ import annotations
+import fcntl
+import logging
+import os
+import re
+import tempfile
+
+
+def parse_depends_on(deployment_data):
+    """
+    Returns the (namespace, name) keys listed in the `kuyala.dependsOn` annotation.
+    Entries are comma separated, either `name` in the namespace of the deployment or `namespace/name`.
+    """
+    keys = []
+    for entry in (deployment_data.get("dependsOn") or "").split(","):
+        entry = entry.strip()
+        if not entry:
+            continue
+        namespace, _, name = entry.rpartition("/")
+        keys.append((namespace or deployment_data["namespace"], name))
+    return keys
+
+
+def dependency_levels(members):
+    """
+    Orders the members of a group into levels, every member depends only on members of the previous levels.
+    Members of one level can be scaled in parallel. Dependencies outside the group are ignored.
+    Raises ValueError when the dependencies form a cycle.
+    """
+    members_by_key = {(d["namespace"], d["name"]): d for d in members}
+    dependencies = {}
+    for key, deployment_data in members_by_key.items():
+        dependencies[key] = set()
+        for dependency in parse_depends_on(deployment_data):
+            if dependency in members_by_key:
+                dependencies[key].add(dependency)
+            else:
+                logging.warning(f"Ignoring dependency of {key[0]}/{key[1]} on {dependency[0]}/{dependency[1]}, it is not a member of group '{deployment_data.get('group')}'")
+
+    levels = []
+    placed = set()
+    while len(placed) < len(members_by_key):
+        level = sorted(key for key, deps in dependencies.items() if key not in placed and deps <= placed)
+        if not level:
+            cycle = sorted(f"{namespace}/{name}" for namespace, name in members_by_key.keys() - placed)
+            raise ValueError(f"Dependency cycle between {', '.join(cycle)}")
+        levels.append([members_by_key[key] for key in level])
+        placed.update(level)
+    return levels
+
+
+def lock_group(group, directory=None):
+    """
+    Takes an exclusive lock of the group shared by all worker processes on this host.
+    Returns the open lock file, closing it releases the lock, or None when the group is already locked.
+    """
+    file_name = "kuyala_group_" + re.sub(r"[^A-Za-z0-9_.-]", "_", group) + ".lock"
+    lock_file = open(os.path.join(directory or tempfile.gettempdir(), file_name), "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
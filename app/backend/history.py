@@ -0,0 +1,151 @@
+from __future__ import annotations
+import threading
+import time
+from array import array
+
+# (resolution in seconds, retention in seconds, capacity), resolution 0 keeps the raw samples
+HISTORY_TIERS = (
+    (0, 3600, 360),
+    (60, 24 * 3600, 24 * 60),
+    (900, 30 * 24 * 3600, 30 * 24 * 4),
+)
+
+
+class RingBuffer:
+    """Fixed size ring of (timestamp, value) samples backed by two float arrays."""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.start = 0
+        self.count = 0
+
+    def covers(self, since: float) -> bool:
+        """False when samples newer than `since` have already been overwritten."""
+        return self.count < self.capacity or self.times[self.start] <= since
+
+    def append(self, timestamp: float, value: float):
+        index = (self.start + self.count) % self.capacity
+        self.times[index] = timestamp
+        self.values[index] = value
+        if self.count < self.capacity:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.capacity
+
+    def range(self, since: float, until: float):
+        """Returns the timestamps and values of the samples within <since, until> in chronological order."""
+        times, values = [], []
+        for i in range(self.count):
+            index = (self.start + i) % self.capacity
+            timestamp = self.times[index]
+            if since <= timestamp <= until:
+                times.append(timestamp)
+                values.append(self.values[index])
+        return times, values
+
+
+class Series:
+    """
+    History of a single metric. Every sample goes to the raw ring, the coarser tiers
+    store the average of each bucket of their resolution once the bucket is complete.
+    """
+
+    def __init__(self, tiers=HISTORY_TIERS):
+        self.tiers = [
+            {"resolution": resolution, "retention": retention, "ring": RingBuffer(capacity),
+             "bucket": None, "sum": 0.0, "samples": 0}
+            for resolution, retention, capacity in tiers
+        ]
+        self.last_update = None
+
+    def add(self, timestamp: float, value: float):
+        self.last_update = timestamp
+        for tier in self.tiers:
+            resolution = tier["resolution"]
+            if not resolution:
+                tier["ring"].append(timestamp, value)
+                continue
+            bucket = timestamp - timestamp % resolution
+            if tier["bucket"] is not None and bucket != tier["bucket"]:
+                tier["ring"].append(tier["bucket"], tier["sum"] / tier["samples"])
+                tier["sum"], tier["samples"] = 0.0, 0
+            tier["bucket"] = bucket
+            tier["sum"] += value
+            tier["samples"] += 1
+
+    def query(self, since: float, until: float):
+        """Returns the finest tier covering `since` as (resolution, timestamps, values)."""
+        tier = next(
+            (t for t in self.tiers if until - since <= t["retention"] and t["ring"].covers(since)),
+            self.tiers[-1]
+        )
+        times, values = tier["ring"].range(since, until)
+        # Include the bucket in progress, so the latest value is always visible
+        if tier["samples"] and since <= tier["bucket"] <= until:
+            times.append(tier["bucket"])
+            values.append(tier["sum"] / tier["samples"])
+        return tier["resolution"], times, values
+
+
+class HistoryStore:
+    """
+    Thread safe collection of metric series with bounded memory.
+    A series which has ended (e.g. of a deleted deployment) is dropped once its longest retention has passed.
+    At most `max_series` series are kept, the least recently updated one is evicted first.
+    """
+
+    def __init__(self, tiers=HISTORY_TIERS, max_series: int = 500):
+        self.tiers = tiers
+        self.max_series = max_series
+        self.retention = max(retention for _, retention, _ in tiers)
+        self._series = {}
+        self._ended = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: str, value, timestamp: float | None = None):
+        timestamp = time.time() if timestamp is None else timestamp
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                if len(self._series) >= self.max_series:
+                    evicted = min(self._series, key=lambda k: self._series[k].last_update)
+                    del self._series[evicted]
+                    self._ended.pop(evicted, None)
+                series = self._series[key] = Series(self.tiers)
+            self._ended.pop(key, None)
+            series.add(timestamp, float(value))
+
+    def end(self, key: str, timestamp: float | None = None):
+        """Marks a series as ended, it is dropped by `prune` after the retention period."""
+        with self._lock:
+            if key in self._series:
+                self._ended[key] = time.time() if timestamp is None else timestamp
+
+    def prune(self, now: float | None = None):
+        """Drops the ended series whose retention has passed."""
+        now = time.time() if now is None else now
+        with self._lock:
+            for key, ended in list(self._ended.items()):
+                if now - ended > self.retention:
+                    del self._series[key]
+                    del self._ended[key]
+
+    def keys(self):
+        with self._lock:
+            return sorted(self._series)
+
+    def query(self, keys, history_range: float, until: float | None = None):
+        """Returns the last `history_range` seconds of the requested series in a columnar format, unknown keys are skipped."""
+        until = time.time() if until is None else until
+        since = until - history_range
+        result = []
+        with self._lock:
+            for key in keys:
+                series = self._series.get(key)
+                if series is None:
+                    continue
+                resolution, times, values = series.query(since, until)
+                result.append({"key": key, "resolution": resolution, "t": times, "v": values})
+        return result
@@ -0,0 +1,103 @@
+from __future__ import annotations
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+import gevent
+from gevent import events
+from gevent.monkey import get_original
+
+# Real sleep, the sampler runs in a native thread while the hub may be blocked
+_native_sleep = get_original('time', 'sleep')
+
+
+class HubMonitor:
+    """
+    Reports every time the gevent hub of this worker is blocked longer than `threshold` seconds.
+
+    Uses the gevent monitoring thread, which runs as a native thread and notifies an
+    `EventLoopBlocked` event with the stack of the greenlet holding the hub.
+    """
+
+    def __init__(self, threshold: float = 0.5):
+        self.threshold = threshold
+        self.blocked_count = 0
+        self.last_blocked_at = None
+        self.last_greenlet = None
+
+    def install(self):
+        gevent.config.monitor_thread = True
+        gevent.config.max_blocking_time = self.threshold
+        # The report goes to the log instead of stderr
+        gevent.config.print_blocking_reports = False
+        events.subscribers.append(self._on_event)
+        gevent.get_hub().start_periodic_monitoring_thread()
+        logging.info(f"Hub monitor installed, reporting blocks longer than {self.threshold}s")
+
+    def _on_event(self, event):
+        if not isinstance(event, events.EventLoopBlocked):
+            return
+        # Called in the native monitoring thread, plain assignments are atomic under the GIL
+        self.blocked_count += 1
+        self.last_blocked_at = time.time()
+        self.last_greenlet = repr(event.greenlet)
+        logging.warning(f"gevent hub blocked for more than {event.blocking_time}s by {event.greenlet!r}\n" + "\n".join(event.info))
+
+    def metrics(self) -> dict:
+        return {
+            "threshold": self.threshold,
+            "blocked_count": self.blocked_count,
+            "last_blocked_at": self.last_blocked_at,
+            "last_greenlet": self.last_greenlet,
+        }
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the thread running the gevent hub and aggregates the samples
+    into the collapsed stack format (`frame;frame;frame count`) read by flamegraph.pl and speedscope.
+    Only one profile runs at a time.
+    """
+
+    def __init__(self, max_seconds: float = 60, min_interval: float = 0.001):
+        self.max_seconds = max_seconds
+        # Sampling holds the GIL, a shorter interval would slow down the worker being measured
+        self.min_interval = min_interval
+        self._running = threading.Lock()
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return f"{code.co_name} ({code.co_filename}:{frame.f_lineno})"
+
+    def _sample(self, thread_ident, seconds, interval):
+        samples = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_ident)
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            if stack:
+                samples[";".join(reversed(stack))] += 1
+            _native_sleep(interval)
+        return samples
+
+    def profile(self, seconds: float, interval: float = 0.01) -> str | None:
+        """
+        Profiles the hub thread for `seconds` and returns the collapsed stacks,
+        None if another profile is already running.
+        The calling greenlet waits cooperatively, the sampling runs in the hub's threadpool.
+        """
+        if not self._running.acquire(blocking=False):
+            return None
+        try:
+            hub = gevent.get_hub()
+            seconds = min(seconds, self.max_seconds)
+            interval = min(max(interval, self.min_interval), seconds)
+            samples = hub.threadpool.spawn(self._sample, hub.thread_ident, seconds, interval).get()
+            return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+        finally:
+            self._running.release()
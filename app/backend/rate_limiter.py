@@ -0,0 +1,133 @@
+from __future__ import annotations
+import random
+import threading
+import time
+import logging
+from enum import IntEnum
+from kubernetes.client.rest import ApiException
+
+
+class Priority(IntEnum):
+    """Priority lanes of the API rate limiter, lower value is served first."""
+    ACTION = 0
+    WATCH = 1
+    SNAPSHOT = 2
+    STATS = 3
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all API callers of one process.
+
+    A caller waits until a token is available and no caller of a higher priority lane is waiting,
+    so a pending user action always overtakes queued snapshots and stats scans.
+    A 429 response blocks the whole bucket for the `Retry-After` period plus a random jitter.
+    """
+
+    def __init__(self, qps: float = 5.0, burst: int = 10, max_retries: int = 5, max_backoff: float = 30.0):
+        self.qps = max(float(qps), 0.001)
+        self.burst = max(int(burst), 1)
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._waiting = {lane: 0 for lane in Priority}
+        self._condition = threading.Condition()
+        self._metrics = {
+            lane: {"requests": 0, "wait_seconds_total": 0.0, "wait_seconds_max": 0.0, "throttled": 0}
+            for lane in Priority
+        }
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.qps)
+        self._last_refill = now
+
+    def _higher_lane_waiting(self, priority: Priority) -> bool:
+        return any(self._waiting[lane] for lane in Priority if lane < priority)
+
+    def acquire(self, priority: Priority = Priority.STATS) -> float:
+        """Blocks until a token is granted to the given lane. Returns the time spent waiting in seconds."""
+        started = time.monotonic()
+        with self._condition:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    if now < self._blocked_until:
+                        timeout = self._blocked_until - now
+                    elif self._higher_lane_waiting(priority):
+                        timeout = None
+                    elif self._tokens >= 1:
+                        self._tokens -= 1
+                        break
+                    else:
+                        timeout = (1 - self._tokens) / self.qps
+                    self._condition.wait(timeout)
+            finally:
+                self._waiting[priority] -= 1
+                # Lower lanes may be parked waiting for this lane to drain
+                self._condition.notify_all()
+
+        waited = time.monotonic() - started
+        lane_metrics = self._metrics[priority]
+        lane_metrics["requests"] += 1
+        lane_metrics["wait_seconds_total"] += waited
+        lane_metrics["wait_seconds_max"] = max(lane_metrics["wait_seconds_max"], waited)
+        return waited
+
+    def backoff(self, attempt: int, retry_after: float | None = None) -> float:
+        """Blocks the bucket after a throttled response. Returns the delay applied."""
+        delay = min(self.max_backoff, 0.5 * 2 ** attempt)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        delay += random.uniform(0, delay / 2)
+        with self._condition:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+            self._condition.notify_all()
+        return delay
+
+    @staticmethod
+    def _retry_after(e: ApiException) -> float | None:
+        headers = e.headers or {}
+        value = headers.get("Retry-After") or headers.get("retry-after")
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
+
+    def call(self, priority: Priority, func, *args, **kwargs):
+        """Calls `func` once a token is granted, retrying on HTTP 429 with jittered backoff."""
+        attempt = 0
+        while True:
+            self.acquire(priority)
+            try:
+                return func(*args, **kwargs)
+            except ApiException as e:
+                if e.status != 429 or attempt >= self.max_retries:
+                    raise
+                self._metrics[priority]["throttled"] += 1
+                delay = self.backoff(attempt, self._retry_after(e))
+                logging.warning(f"API server throttled {getattr(func, '__name__', 'call')} ({priority.name}), backing off {delay:.1f}s")
+                attempt += 1
+
+    def metrics(self) -> dict:
+        """Returns the per-lane wait time metrics and the bucket state."""
+        with self._condition:
+            self._refill(time.monotonic())
+            return {
+                "qps": self.qps,
+                "burst": self.burst,
+                "tokens": round(self._tokens, 2),
+                "blocked_for": round(max(0.0, self._blocked_until - time.monotonic()), 2),
+                "lanes": {
+                    lane.name.lower(): {
+                        **self._metrics[lane],
+                        "waiting": self._waiting[lane],
+                        "wait_seconds_avg": self._metrics[lane]["wait_seconds_total"] / self._metrics[lane]["requests"]
+                        if self._metrics[lane]["requests"] else 0.0,
+                    }
+                    for lane in Priority
+                },
+            }